@@ -1,36 +1,15 @@
-import math
-
 import dramatiq
-from dramatiq.middleware import CurrentMessage
-
 
-def update_task_progress(current, total, task):
-    """
-    Return True if updated
-    Return False if not.
-    """
-    if total >= 50:
-        progress = (current / total) * 100
-        progress = math.ceil(progress)
-        if progress % 10 == 0:
-            task.progress = progress
-            task.save()
-            return True
-    return False
+from taskstate.middleware import StateMiddleware
 
 
 @dramatiq.actor(max_retries=0)
 def progress_task(arg, for_state={}):
-    # Make sure to use dramatiq.middleware.CurrentMessage in
-    # your Dramatiq middleware otherwise this won't work.
-    # We need the message to lookup the task.
-    # https://dramatiq.io/reference.html#dramatiq.middleware.CurrentMessage
-    message = CurrentMessage.get_current_message()
-    task = None
-    try:
-        task = Task.objects.get(message_id=message.message_id)
-    except Task.DoesNotExist:
-        pass
+    # The middleware sets a handle to the task of the current message
+    # when it is tracked (i.e. when `for_state` was passed). This does
+    # not query the database. If the task state is not tracked this
+    # will be None.
+    task = StateMiddleware.get_current_task()
 
     things = [
         'thing',
@@ -50,5 +29,6 @@ def progress_task(arg, for_state={}):
     for thing in things:
         current += 1
         if task:
-            update_task_progress(current, total, task)
+            # Only saves the progress when it changes by 10 percent.
+            task.update_progress(current, total)
     return
@@ -44,6 +44,9 @@ setuptools.setup(
         'websockets': [
             'channels',
             'redis',
-        ]
+        ],
+        'orjson': [
+            'orjson',
+        ],
     }
 )
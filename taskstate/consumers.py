@@ -1,12 +1,78 @@
+import asyncio
 import json
 from datetime import timedelta
+from urllib.parse import parse_qs
 
+from channels.db import database_sync_to_async
+from channels.exceptions import StopConsumer
+from channels.generic.http import AsyncHttpConsumer
 from channels.generic.websocket import WebsocketConsumer
 from django.db import IntegrityError
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.db.models import Case, Value, When
 
-from taskstate.models import Task, Channel
+from taskstate import routers
+from taskstate.models import Task, Channel, decode_cursor
+from taskstate.serializers import (
+    TASK_VALUES_FIELDS,
+    dumps,
+    dumps_tasks,
+    serialize_results,
+)
+
+
+
+
+def get_tasks_for_event(user, event):
+    """
+    Returns the values of the unseen tasks of `user` for a
+    `task.status.update` event (see `taskstate.receivers.send_to_channel`).
+
+    Events are sent right after a task was written to the write database,
+    usually by another process, so a read replica might not have the change
+    yet. In that case the tasks are read from the write database instead;
+    otherwise the client would be sent the old status and never receive
+    the new one.
+    """
+    task_list = list(
+        Task.objects.for_read().unseen_for_user(
+            user,
+            event['pk_list'],
+        ).values(*TASK_VALUES_FIELDS)
+    )
+    write_database = routers.get_write_database()
+    if routers.get_read_database() == write_database:
+        return task_list
+
+    changed_pk = event.get('changed_pk', None)
+    last_modified = parse_datetime(event.get('last_modified', None) or '')
+    if changed_pk is None or last_modified is None:
+        return task_list
+    for task in task_list:
+        if task['pk'] == changed_pk:
+            if task['last_modified'] >= last_modified:
+                return task_list
+            break
+
+    return list(
+        Task.objects.using(write_database).unseen_for_user(
+            user,
+            event['pk_list'],
+        ).values(*TASK_VALUES_FIELDS)
+    )
+
+
+def get_results_for_event(event):
+    """
+    Returns the primary keys of the tasks whose results should be sent for
+    a `task.status.update` event. Results are only sent when the status of
+    a task changed so that they are not sent again with every update of
+    another task.
+    """
+    if event.get('status_changed', False):
+        return [event['changed_pk']]
+    return []
 
 
 
@@ -45,6 +111,36 @@ class SetTaskSeen(BaseAuthWebsocketConsumer):
     def receive(self, text_data):
         super().receive(text_data)
         Task.set_seen_tasks(self.pk_list)
+        # Send the next requests of the client to the write database as
+        # well (see `taskstate.routers.PinningMiddleware`).
+        session = self.scope.get('session', None)
+        if session is not None:
+            routers.pin_session(session)
+            session.save()
+
+
+
+
+class GetTaskResults(BaseAuthWebsocketConsumer):
+    """
+    A websocket consumer that sends the full results of completed tasks.
+    Results are not included in status updates when they are too large to
+    be stored inline, so the client must request them here.
+    """
+
+    def receive(self, text_data):
+        super().receive(text_data)
+        values_list = Task.objects.for_read().filter(
+            pk__in=self.pk_list,
+            user=self.user,
+            status__in=Task.COMPLETE_STATUSES,
+        ).values(
+            'pk',
+            'results',
+            'results_offloaded',
+            'stored_results__data',
+        )
+        self.send(text_data=dumps(serialize_results(values_list)))
 
 
 
@@ -57,7 +153,7 @@ class CheckTaskStatus(BaseAuthWebsocketConsumer):
     def connect(self):
         super().connect()
         try:
-            Channel.objects.create(name=self.channel_name)
+            Channel.objects.for_write().create(name=self.channel_name)
         except IntegrityError:
             pass
 
@@ -65,20 +161,28 @@ class CheckTaskStatus(BaseAuthWebsocketConsumer):
     def disconnect(self, close_code):
         # Note that in some rare cases (power loss, etc)
         # disconnect may fail to run.
-        Channel.objects.filter(name=self.channel_name).delete()
+        Channel.objects.for_write().filter(name=self.channel_name).delete()
 
 
     def receive(self, text_data):
         super().receive(text_data)
         pk_list = self.pk_list
 
-        channel = Channel.objects.get(
+        channel = Channel.objects.for_write().get(
             name=self.channel_name,
         )
         channel.task_pk_list = pk_list
         channel.save()
 
-        task_list = self.get_tasks(pk_list)
+        # A client that reconnects can send the cursor from the last message
+        # it received to only get the tasks that changed since.
+        cursor = self.text_data_json.get('cursor', None)
+        try:
+            decode_cursor(cursor)
+        except ValueError:
+            cursor = None
+
+        task_list = list(self.get_tasks(pk_list, cursor=cursor))
 
         # Need to send the results back immediately in case the task completes
         # very quickly. If the task is completed before this runs the results
@@ -86,35 +190,144 @@ class CheckTaskStatus(BaseAuthWebsocketConsumer):
         # enough time to create the channel object. No channel object means
         # that the signal receivers for `task_changed` and `post_save` won't
         # be able to find the right channel to send the status/progress to.
-        self.send_tasks(task_list)
+        # This is the first message for these tasks, so include the results
+        # of tasks that are already complete.
+        self.send_tasks(
+            task_list,
+            cursor=cursor,
+            results_for=[task['pk'] for task in task_list],
+        )
 
 
-    def get_tasks(self, pk_list):
-        task_list = Task.objects.filter(
-            pk__in=pk_list,
-            user=self.user,
-            seen=False,
+    def get_tasks(self, pk_list, cursor=None):
+        task_list = Task.objects.for_read().unseen_for_user(
+            self.user,
+            pk_list,
         )
-        return task_list
+        if cursor is not None:
+            task_list = task_list.changed_since(cursor)
+        return task_list.values(*TASK_VALUES_FIELDS)
 
 
-    def send_tasks(self, task_list):
-        self.send(text_data=json.dumps({
-            'tasks': [
-                {
-                    'id': task.pk,
-                    'pk': task.pk,
-                    'status': task.status,
-                    'progress': task.progress or '',
-                    'description': task.description or '',
-                    'results': task.results,
-                }
-                for task in task_list
-            ],
-        }))
+    def send_tasks(self, task_list, cursor=None, results_for=()):
+        """
+        Send a list of task value dictionaries (as returned by `get_tasks`)
+        to the client, including the results of the tasks in `results_for`.
+        """
+        self.send(text_data=dumps_tasks(
+            task_list,
+            cursor=cursor,
+            results_for=results_for,
+        ))
 
 
     def task_status_update(self, event):
-        pk_list = event['pk_list']
-        task_list = self.get_tasks(pk_list)
-        self.send_tasks(task_list)
+        task_list = get_tasks_for_event(self.user, event)
+        self.send_tasks(task_list, results_for=get_results_for_event(event))
+
+
+
+
+class TaskStatusStream(AsyncHttpConsumer):
+    """
+    An HTTP consumer that streams the status of tasks as server-sent events
+    for clients that can't use websockets. The tasks are given in the `pk`
+    query string parameters, for example: `?pk=1&pk=2`.
+
+    A `Channel` object is created for the stream in the same way as the
+    `CheckTaskStatus` websocket consumer does, so the `task_changed` and
+    `post_save` receivers send updates to this stream as well. The stream
+    ends once all the tasks are complete.
+    """
+    # Seconds between keep-alive comments sent on an idle stream.
+    keepalive = 15
+    keepalive_task = None
+    user = None
+    pk_list = None
+
+    async def http_request(self, message):
+        # Unlike `AsyncHttpConsumer`, don't stop the consumer after `handle`
+        # so that the response stays open for `task_status_update` events.
+        if 'body' in message:
+            self.body.append(message['body'])
+        if not message.get('more_body'):
+            await self.handle(b''.join(self.body))
+
+
+    async def handle(self, body):
+        self.user = self.scope.get('user', None)
+        if self.user is None or not self.user.is_authenticated:
+            await self.send_response(403, b'', headers=[
+                (b'Content-Type', b'text/plain'),
+            ])
+            raise StopConsumer()
+
+        query = parse_qs(self.scope.get('query_string', b'').decode('latin-1'))
+        self.pk_list = []
+        for pk in query.get('pk', []):
+            try:
+                self.pk_list.append(int(pk))
+            except ValueError:
+                pass
+
+        await self.send_headers(headers=[
+            (b'Content-Type', b'text/event-stream'),
+            (b'Cache-Control', b'no-cache'),
+            (b'X-Accel-Buffering', b'no'),
+        ])
+        await database_sync_to_async(Channel.objects.for_write().create)(
+            name=self.channel_name,
+            task_pk_list=self.pk_list,
+            user=self.user,
+        )
+        self.keepalive_task = asyncio.ensure_future(self.send_keepalive())
+
+        # Send the current state immediately in case the tasks complete
+        # before the channel object was created.
+        task_list = await self.get_tasks(self.pk_list)
+        await self.send_tasks(task_list, results_for=self.pk_list)
+
+
+    async def send_keepalive(self):
+        while True:
+            await asyncio.sleep(self.keepalive)
+            await self.send_body(b': keep-alive\n\n', more_body=True)
+
+
+    @database_sync_to_async
+    def get_tasks(self, pk_list):
+        return list(
+            Task.objects.for_read().unseen_for_user(
+                self.user,
+                pk_list,
+            ).values(*TASK_VALUES_FIELDS)
+        )
+
+
+    async def send_tasks(self, task_list, results_for=()):
+        data = dumps_tasks(task_list, results_for=results_for)
+        await self.send_body(
+            'data: {0}\n\n'.format(data).encode('utf-8'),
+            more_body=True,
+        )
+        if all(task['status'] in Task.COMPLETE_STATUSES for task in task_list):
+            await self.send_body(b'')
+            await self.disconnect()
+            raise StopConsumer()
+
+
+    async def task_status_update(self, event):
+        task_list = await database_sync_to_async(get_tasks_for_event)(
+            self.user,
+            event,
+        )
+        await self.send_tasks(task_list, results_for=get_results_for_event(event))
+
+
+    async def disconnect(self):
+        if self.keepalive_task is not None:
+            self.keepalive_task.cancel()
+            self.keepalive_task = None
+        await database_sync_to_async(
+            Channel.objects.for_write().filter(name=self.channel_name).delete
+        )()
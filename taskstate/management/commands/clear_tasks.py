@@ -1,33 +1,77 @@
-import os
-import sys
-from datetime import datetime
+from datetime import timedelta
 
 from django.core.management.base import BaseCommand, CommandError
-from django.contrib.auth import get_user_model
-from django.conf import settings
+from django.db import connections
+from django.utils import timezone
 
-from taskstate.models import Task
+from taskstate import routers
+from taskstate.models import Task, TaskResults
 
 
-User = get_user_model()
-
 
 
 class Command(BaseCommand):
     """
     Usage:
     python manage.py clear_tasks
+    python manage.py clear_tasks --status done --status failed --older-than 3600
+    python manage.py clear_tasks --queue-name default --dry-run
+
+    Without any filters all tasks are removed with `TRUNCATE` on PostgreSQL.
+    With filters, tasks are deleted in chunks of `--chunk-size` tasks.
     """
     help = 'Clear all tasks in database for dramatiq-taskstate'
 
     def add_arguments(self, parser):
         parser.add_argument(
-            '-y, --yes',
+            '-y', '--yes',
             action='store_true',
             default=None,
             help='Continue without asking confirmation.',
             dest='yes',
         )
+        parser.add_argument(
+            '--status',
+            action='append',
+            choices=[status for status, label in Task.STATUSES],
+            help='Only delete tasks with this status. Can be used more than once.',
+            dest='status',
+        )
+        parser.add_argument(
+            '--queue-name',
+            help='Only delete tasks from this queue.',
+            dest='queue_name',
+        )
+        parser.add_argument(
+            '--actor-name',
+            help='Only delete tasks for this actor.',
+            dest='actor_name',
+        )
+        parser.add_argument(
+            '--user',
+            help='Only delete tasks of the user with this primary key.',
+            dest='user',
+        )
+        parser.add_argument(
+            '--older-than',
+            type=int,
+            help='Only delete tasks created more than this many seconds ago.',
+            dest='older_than',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help='Number of tasks to delete per query when filtering (default: 1000).',
+            dest='chunk_size',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            default=False,
+            help='Only show how many tasks would be deleted.',
+            dest='dry_run',
+        )
 
 
     def set_options(self, **options):
@@ -35,25 +79,135 @@ class Command(BaseCommand):
         Set instance variables based on an options dict
         """
         self.yes = options['yes']
+        self.status = options['status']
+        self.queue_name = options['queue_name']
+        self.actor_name = options['actor_name']
+        self.user = options['user']
+        self.older_than = options['older_than']
+        self.chunk_size = options['chunk_size']
+        self.dry_run = options['dry_run']
+        if self.chunk_size < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+
+    def get_filters(self):
+        filters = {}
+        if self.status:
+            filters['status__in'] = self.status
+        if self.queue_name is not None:
+            filters['queue_name'] = self.queue_name
+        if self.actor_name is not None:
+            filters['actor_name'] = self.actor_name
+        if self.user is not None:
+            filters['user'] = self.user
+        if self.older_than is not None:
+            filters['created_date__lte'] = (
+                timezone.now() - timedelta(seconds=self.older_than)
+            )
+        return filters
 
 
     def handle(self, **options):
         self.set_options(**options)
+        self.database = routers.get_write_database()
+        filters = self.get_filters()
+
+        if self.dry_run:
+            if filters:
+                count = Task.objects.for_write().filter(**filters).count()
+                msg = 'Would delete {0} tasks'.format(count)
+            else:
+                count = self.estimate_count()
+                if count is None:
+                    msg = 'Would delete all tasks (unknown number of tasks)'
+                else:
+                    msg = 'Would delete all tasks (about {0})'.format(count)
+            self.log(msg)
+            return
+
         start = True
         if not self.yes:
-            yes_no = input('This will delete all tasks in database, are you sure? [y/N]: ')
+            if filters:
+                question = 'This will delete all matching tasks in database, are you sure? [y/N]: '
+            else:
+                question = 'This will delete all tasks in database, are you sure? [y/N]: '
+            yes_no = input(question)
             start = (
                 yes_no == 'yes' or yes_no == 'y'
             )
         if start:
             self.log('\n')
-            objs = Task.objects.all().delete()
-            msg = 'Deleted {0} tasks'.format(len(objs))
+            if filters:
+                deleted = self.delete_chunked(filters)
+                msg = 'Deleted {0} tasks'.format(deleted)
+            else:
+                self.truncate()
+                msg = 'Deleted all tasks'
             self.log(msg)
             self.log('\n')
         else:
             raise CommandError('Command cancelled')
 
 
+    def estimate_count(self):
+        """
+        Returns the number of tasks from the PostgreSQL statistics, which
+        does not need to scan the table, or None if the table has not been
+        analyzed yet. Other databases use `count()`.
+        """
+        connection = connections[self.database]
+        if connection.vendor != 'postgresql':
+            return Task.objects.for_write().count()
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT reltuples::bigint FROM pg_class WHERE oid = %s::regclass',
+                [Task._meta.db_table],
+            )
+            row = cursor.fetchone()
+        # reltuples is -1 for a table that was never analyzed (PostgreSQL 14+).
+        if not row or row[0] < 0:
+            return None
+        return row[0]
+
+
+    def truncate(self):
+        """
+        Deletes all tasks with `TRUNCATE` on PostgreSQL. The tasks are not
+        counted first since that would need a scan of the whole table.
+        """
+        connection = connections[self.database]
+        if connection.vendor != 'postgresql':
+            self.delete_chunked({})
+            return
+        tables = ', '.join(
+            connection.ops.quote_name(model._meta.db_table)
+            for model in [Task, TaskResults]
+        )
+        with connection.cursor() as cursor:
+            cursor.execute('TRUNCATE TABLE {0}'.format(tables))
+
+
+    def delete_chunked(self, filters):
+        """
+        Deletes the tasks matching `filters` in chunks of `chunk_size`
+        tasks and returns the number of tasks that were deleted.
+        """
+        tasks = Task.objects.for_write().filter(**filters)
+        total = tasks.count()
+        deleted = 0
+        while True:
+            pk_list = list(
+                tasks.order_by('pk').values_list('pk', flat=True)[:self.chunk_size]
+            )
+            if not pk_list:
+                break
+            count, per_model = Task.objects.for_write().filter(
+                pk__in=pk_list,
+            ).only('pk').delete()
+            deleted += per_model.get(Task._meta.label, 0)
+            self.log('Deleted {0} of {1} tasks'.format(deleted, total))
+        return deleted
+
+
     def log(self, msg, level=1):
         self.stdout.write(msg)
@@ -1,10 +1,73 @@
 import logging
+import math
+import threading
 
+from asgiref.local import Local
 from dramatiq.middleware import Middleware
 
 
 logger = logging.getLogger('taskstate.StateMiddleware')
 
+# Holds the `CurrentTask` of the message being processed in the current
+# worker thread (or async context).
+_local = Local()
+
+
+
+
+class CurrentTask:
+    """
+    A lightweight handle to the task of the message that is currently being
+    processed. Available to actors through `StateMiddleware.get_current_task()`
+    without querying the database for the task.
+    """
+
+    def __init__(self, pk, message_id, progress=None):
+        self.pk = pk
+        self.message_id = message_id
+        self.progress = progress
+
+
+    def __repr__(self):
+        return '<CurrentTask pk={0!r}>'.format(self.pk)
+
+
+    def set_progress(self, progress):
+        """
+        Saves the progress (0 to 100) of the task with a single `UPDATE`
+        query and notifies the websocket consumers.
+        """
+        from django.utils import timezone
+        from taskstate.models import Task
+        from taskstate.receivers import send_task_update
+        last_modified = timezone.now()
+        Task.objects.for_write().filter(pk=self.pk).update(
+            progress=progress,
+            last_modified=last_modified,
+        )
+        self.progress = progress
+        send_task_update(self.pk, last_modified=last_modified)
+
+
+    def update_progress(self, current, total, step=10):
+        """
+        Sets the progress of the task from the number of items processed
+        so far, rounded down to a multiple of `step`. The progress is only
+        saved when it changes; by default that is every 10 percent.
+        The progress is 100 if `total` is 0.
+        Return True if updated.
+        Return False if not.
+        """
+        if total > 0:
+            progress = min(math.ceil((current / total) * 100), 100)
+            progress -= progress % step
+        else:
+            progress = 100
+        if progress == self.progress:
+            return False
+        self.set_progress(progress)
+        return True
+
 
 
 
@@ -37,9 +100,74 @@ class StateMiddleware(Middleware):
     The middleware only checks for the existence of this keyword argument.
     Therefore, if it's completely empty the task object will still be created
     and updated.
+
+    While a worker is running, the `heartbeat` of all the tasks it is
+    currently processing is refreshed every `TASKSTATE_HEARTBEAT_INTERVAL`
+    seconds (30 by default) with a single query. Running tasks with an
+    expired heartbeat can be marked as failed with `Task.objects.fail_dead()`.
     """
     for_state = None
 
+    def __init__(self):
+        # Maps message ID's to the primary keys and attempts (number of
+        # retries) of the tracked tasks that are currently being processed
+        # by this worker.
+        self.in_flight = {}
+        self.in_flight_lock = threading.Lock()
+        self.heartbeat_stop = threading.Event()
+        self.heartbeat_thread = None
+
+
+    def after_worker_boot(self, broker, worker):
+        self.heartbeat_stop.clear()
+        self.heartbeat_thread = threading.Thread(
+            target=self.heartbeat_loop,
+            name='taskstate-heartbeat',
+            daemon=True,
+        )
+        self.heartbeat_thread.start()
+
+
+    def before_worker_shutdown(self, broker, worker):
+        self.heartbeat_stop.set()
+        if self.heartbeat_thread is not None:
+            self.heartbeat_thread.join()
+            self.heartbeat_thread = None
+
+
+    def heartbeat_loop(self):
+        from django.conf import settings
+        interval = getattr(settings, 'TASKSTATE_HEARTBEAT_INTERVAL', 30)
+        while not self.heartbeat_stop.wait(interval):
+            try:
+                self.send_heartbeats()
+            except Exception:
+                logger.exception('Failed to update task heartbeats.')
+
+
+    def send_heartbeats(self):
+        """
+        Refreshes the heartbeat of all in-flight tasks in a single query.
+        """
+        from django.db import close_old_connections
+        from taskstate.models import Task
+        with self.in_flight_lock:
+            pk_list = [pk for pk, attempt in self.in_flight.values()]
+        if not pk_list:
+            return
+        close_old_connections()
+        Task.objects.update_heartbeats(pk_list)
+
+
+    @classmethod
+    def get_current_task(cls):
+        """
+        Returns a `CurrentTask` handle for the message that is currently
+        being processed or None if the message's task state is not tracked.
+        """
+        return getattr(_local, 'current_task', None)
+
+
     def send_signal(self, task):
         from taskstate.signals import task_changed
         task_changed.send(
@@ -91,8 +219,10 @@ class StateMiddleware(Middleware):
         status = Task.STATUS_ENQUEUED
         if delay:
             status = Task.STATUS_DELAYED
+        attempt = message.options.get('retries', 0)
         task = Task.objects.create_or_update_from_message(
             message,
+            attempt=attempt,
             status=status,
             actor_name=message.actor_name,
             queue_name=message.queue_name,
@@ -101,17 +231,21 @@ class StateMiddleware(Middleware):
             app_name=self.for_state.get('app_name', ''),
             description=self.for_state.get('description', 'Task'),
         )
-        self.send_signal(task)
+        if task.version == Task.get_version(status, attempt):
+            self.send_signal(task)
 
 
     def before_process_message(self, broker, message):
         if not self.should_track(message):
             return
+        from django.utils import timezone
         from taskstate.models import Task
         user = self.get_user(message)
         logger.debug('Updating Task from message %r.', message.message_id)
+        attempt = message.options.get('retries', 0)
         task = Task.objects.create_or_update_from_message(
             message,
+            attempt=attempt,
             status=Task.STATUS_RUNNING,
             actor_name=message.actor_name,
             queue_name=message.queue_name,
@@ -119,8 +253,17 @@ class StateMiddleware(Middleware):
             model_name=self.for_state.get('model_name', ''),
             app_name=self.for_state.get('app_name', ''),
             description=self.for_state.get('description', 'Task'),
+            heartbeat=timezone.now(),
         )
-        self.send_signal(task)
+        with self.in_flight_lock:
+            self.in_flight[message.message_id] = (task.pk, attempt)
+        _local.current_task = CurrentTask(
+            task.pk,
+            message.message_id,
+            task.progress,
+        )
+        if task.version == Task.get_version(Task.STATUS_RUNNING, attempt):
+            self.send_signal(task)
 
 
     def after_skip_message(self, broker, message):
@@ -129,6 +272,9 @@ class StateMiddleware(Middleware):
 
 
     def after_process_message(self, broker, message, *, result=None, exception=None, status=None):
+        with self.in_flight_lock:
+            pk, attempt = self.in_flight.pop(message.message_id, (None, None))
+        _local.current_task = None
         if not self.should_track(message):
             return
         from taskstate.models import Task
@@ -139,9 +285,15 @@ class StateMiddleware(Middleware):
         elif status is None:
             status = Task.STATUS_DONE
 
+        # The Retries middleware may have already increased the number of
+        # retries of the message, so use the attempt that was processed.
+        if attempt is None:
+            attempt = message.options.get('retries', 0)
+
         logger.debug('Updating Task from message %r.', message.message_id)
         task = Task.objects.create_or_update_from_message(
             message,
+            attempt=attempt,
             status=status,
             actor_name=message.actor_name,
             queue_name=message.queue_name,
@@ -150,4 +302,5 @@ class StateMiddleware(Middleware):
             app_name=self.for_state.get('app_name', ''),
             description=self.for_state.get('description', 'Task'),
         )
-        self.send_signal(task)
+        if task.version == Task.get_version(status, attempt):
+            self.send_signal(task)
@@ -0,0 +1,30 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:04
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskstate', '0003_task_results'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='task',
+            name='results_offloaded',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.CreateModel(
+            name='TaskResults',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('data', models.JSONField(blank=True, null=True)),
+                ('task', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stored_results', to='taskstate.task')),
+            ],
+            options={
+                'default_permissions': [],
+            },
+        ),
+    ]
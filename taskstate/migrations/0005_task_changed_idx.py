@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:06
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('taskstate', '0004_task_results_offloaded'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='task',
+            index=models.Index(fields=['last_modified', 'id'], name='taskstate_task_changed_idx'),
+        ),
+    ]
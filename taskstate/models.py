@@ -1,10 +1,13 @@
 # Copied and changed from https://github.com/Bogdanp/django_dramatiq/blob/master/django_dramatiq/models.py
 
+import base64
+import json
 from datetime import timedelta
 
-from django.db import models
+from django.db import IntegrityError, models, transaction
 from django.utils.functional import cached_property
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 from django.db.models import Q
 from django.conf import settings
 from django.core.validators import MinValueValidator, MaxValueValidator
@@ -13,23 +16,151 @@ from django.contrib.postgres.fields import ArrayField
 from dramatiq import Message
 from django_dramatiq.apps import DjangoDramatiqConfig
 
+from taskstate import routers
+
 # The database label to use when storing task metadata.
 DATABASE_LABEL = DjangoDramatiqConfig.tasks_database()
 
 
 
 
-class TaskManager(models.Manager):
+def encode_cursor(last_modified, pk):
+    """
+    Returns an opaque cursor for a position in the change feed of tasks.
+    """
+    value = '{0}|{1}'.format(last_modified.isoformat(), pk)
+    return base64.urlsafe_b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """
+    Returns a `(last_modified, pk)` tuple from a cursor created with
+    `encode_cursor`. Raises a `ValueError` if the cursor is invalid.
+    """
+    try:
+        value = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        last_modified, pk = value.rsplit('|', 1)
+        last_modified = parse_datetime(last_modified)
+        pk = int(pk)
+    except (AttributeError, TypeError, UnicodeError, ValueError) as e:
+        raise ValueError('Invalid cursor: {0!r}'.format(cursor)) from e
+    if last_modified is None:
+        raise ValueError('Invalid cursor: {0!r}'.format(cursor))
+    return last_modified, pk
+
+
+
+
+class RoutedQuerySet(models.QuerySet):
+    """
+    Sends reads to the write database for a while after a write in the
+    same thread or async context (see `taskstate.routers.pin`).
+    """
+
+    def update(self, **kwargs):
+        rows = super().update(**kwargs)
+        routers.pin()
+        return rows
+
+
+    def delete(self):
+        deleted = super().delete()
+        routers.pin()
+        return deleted
+
+
+
+
+class TaskQuerySet(RoutedQuerySet):
+
+    def unseen_for_user(self, user, pk_list):
+        """
+        Returns the tasks from `pk_list` that belong to `user` and have not
+        been seen yet. These are the tasks that clients are sent status
+        updates for.
+        """
+        return self.filter(
+            pk__in=pk_list,
+            user=user,
+            seen=False,
+        )
+
 
-    def create_or_update_from_message(self, message, **extra_fields):
-        task, created = self.using(DATABASE_LABEL).update_or_create(
+    def changed_since(self, cursor=None):
+        """
+        Returns the tasks that were modified after the position given by
+        `cursor` (see `encode_cursor`), ordered from oldest to newest change.
+        The primary key is used as a tie-breaker for tasks with the same
+        `last_modified` value. All tasks are returned if `cursor` is None.
+        """
+        tasks = self
+        if cursor is not None:
+            last_modified, pk = decode_cursor(cursor)
+            tasks = tasks.filter(
+                Q(last_modified__gt=last_modified)
+                | Q(last_modified=last_modified, pk__gt=pk)
+            )
+        return tasks.order_by('last_modified', 'pk')
+
+
+
+
+class RoutedManagerMixin:
+    """
+    Adds methods to get querysets for the taskstate read and write databases
+    (see `taskstate.routers`).
+    """
+
+    def for_read(self):
+        return self.using(routers.get_read_database())
+
+
+    def for_write(self):
+        return self.using(routers.get_write_database())
+
+
+
+
+class TaskManager(RoutedManagerMixin, models.Manager.from_queryset(TaskQuerySet)):
+
+    def create_or_update_from_message(self, message, attempt=None, **extra_fields):
+        """
+        Creates or updates the task for `message` without locking.
+
+        The update is only applied when the new version of the task (see
+        `Task.get_version`) is greater than the version in the database, so
+        a late or repeated update can't overwrite a newer status. `attempt`
+        is the number of times the message has been retried and defaults to
+        the `retries` option of the message.
+
+        Returns the task as it is in the database after the update. Its
+        `version` will only be equal to the new version if the update
+        was applied.
+        """
+        if attempt is None:
+            attempt = message.options.get('retries', 0)
+        status = extra_fields.get('status', Task.STATUS_ENQUEUED)
+        fields = {
+            'message_data': message.encode(),
+            'version': Task.get_version(status, attempt),
+            **extra_fields,
+        }
+        tasks = self.for_write()
+        updated = tasks.filter(
             message_id=message.message_id,
-            defaults={
-                'message_data': message.encode(),
-                **extra_fields,
-            }
+            version__lt=fields['version'],
+        ).update(
+            last_modified=timezone.now(),
+            **fields,
         )
-        return task
+        if not updated:
+            try:
+                with transaction.atomic(using=tasks.db):
+                    tasks.create(message_id=message.message_id, **fields)
+            except IntegrityError:
+                # The task exists and has the same or a newer version.
+                pass
+        return tasks.get(message_id=message.message_id)
 
 
     def delete_old(self, max_task_age, only_if_seen=True):
@@ -42,7 +173,8 @@ class TaskManager(models.Manager):
         - If `only_if_seen` keyword argument is set then it will only
           delete a task if it has been marked as seen.
         """
-        tasks = self.completed().filter(
+        tasks = self.for_write().filter(
+            status__in=Task.COMPLETE_STATUSES,
             created_date__lte=timezone.now() - timedelta(seconds=max_task_age)
         )
         if only_if_seen:
@@ -52,7 +184,7 @@ class TaskManager(models.Manager):
 
     def delete_stale(self, max_age=1200):
         # max_age = 1200 seconds = 20 minutes
-        tasks = self.using(DATABASE_LABEL).filter(
+        tasks = self.for_write().filter(
             status=Task.STATUS_ENQUEUED
         ).filter(
             created_date__lte=timezone.now() - timedelta(seconds=max_age)
@@ -60,22 +192,109 @@ class TaskManager(models.Manager):
         tasks.delete()
 
 
+    def update_heartbeats(self, pk_list):
+        """
+        Sets the heartbeat of all the tasks in `pk_list` to the current time
+        with a single `UPDATE` query. `last_modified` is not changed because
+        a heartbeat is not a change in the state of a task.
+        """
+        return self.for_write().filter(
+            pk__in=pk_list,
+        ).update(
+            heartbeat=timezone.now(),
+        )
+
+
+    def fail_dead(self, max_age=None):
+        """
+        Marks running tasks as failed when their heartbeat has not been
+        refreshed in the last `max_age` seconds, which means that the worker
+        processing the task has died. `max_age` defaults to the
+        `TASKSTATE_HEARTBEAT_TIMEOUT` setting (120 seconds).
+        Returns a list of the tasks that were marked as failed.
+        """
+        if max_age is None:
+            max_age = getattr(settings, 'TASKSTATE_HEARTBEAT_TIMEOUT', 120)
+        cutoff = timezone.now() - timedelta(seconds=max_age)
+        tasks = self.for_write().filter(
+            status=Task.STATUS_RUNNING,
+        ).filter(
+            Q(heartbeat__lte=cutoff)
+            | Q(heartbeat__isnull=True, last_modified__lte=cutoff)
+        )
+        pk_list = list(tasks.values_list('pk', flat=True))
+        if not pk_list:
+            return []
+        # Filter again in case a heartbeat was refreshed in the meantime.
+        # The version is not changed so that the updates of a worker that
+        # was only late, or of a redelivered message (which does not count
+        # as a retry), are still applied.
+        tasks.filter(pk__in=pk_list).update(
+            status=Task.STATUS_FAILED,
+            last_modified=timezone.now(),
+        )
+        return list(self.for_write().filter(
+            pk__in=pk_list,
+            status=Task.STATUS_FAILED,
+        ))
+
+
     def completed(self):
-        return self.using(DATABASE_LABEL).filter(
+        return self.for_read().filter(
             Q(status=Task.STATUS_DONE)
             | Q(status=Task.STATUS_FAILED)
             | Q(status=Task.STATUS_SKIPPED)
         )
 
 
-    def for_display(self, seconds_since_seen=30):
-        tasks = self.using(DATABASE_LABEL).filter(
+    def for_display(self, seconds_since_seen=30, fields=None):
+        """
+        Returns tasks that have been seen in the last `seconds_since_seen`
+        seconds and tasks that have not been seen yet.
+
+        If `fields` is given only those fields are loaded from the database,
+        which avoids fetching large columns like `message_data` when the
+        tasks are only rendered in a template. `Task.DISPLAY_FIELDS` contains
+        the fields used by the default template.
+        """
+        tasks = self.for_read().filter(
             Q(seen_at__gte=timezone.now() - timedelta(seconds=seconds_since_seen))
             | Q(seen=False)
         )
+        if fields is not None:
+            tasks = tasks.only(*fields)
         return tasks
 
 
+    def for_display_page(self, cursor=None, limit=25, seconds_since_seen=30, fields=None):
+        """
+        Returns a `(tasks, next_cursor)` tuple with a page of tasks from
+        `for_display`, most recently modified first. Pass `next_cursor` back
+        to get the next page; it is None on the last page.
+
+        Unlike offset-based pagination, the database does not need to scan
+        the rows of previous pages to find the start of a page.
+        """
+        if fields is not None:
+            fields = [*fields, 'last_modified']
+        tasks = self.for_display(
+            seconds_since_seen=seconds_since_seen,
+            fields=fields,
+        ).order_by('-last_modified', '-pk')
+        if cursor is not None:
+            last_modified, pk = decode_cursor(cursor)
+            tasks = tasks.filter(
+                Q(last_modified__lt=last_modified)
+                | Q(last_modified=last_modified, pk__lt=pk)
+            )
+        tasks = list(tasks[:limit + 1])
+        next_cursor = None
+        if len(tasks) > limit:
+            tasks = tasks[:limit]
+            next_cursor = encode_cursor(tasks[-1].last_modified, tasks[-1].pk)
+        return tasks, next_cursor
+
+
 
 
 class Task(models.Model):
@@ -108,6 +327,31 @@ class Task(models.Model):
         STATUS_FAILED,
         STATUS_SKIPPED,
     ]
+    # Statuses can only move forward in this order during an attempt to
+    # process a message; see `get_version`.
+    # A delayed message is enqueued again when it's due, so `enqueued` comes
+    # after `delayed`.
+    STATUS_ORDER = {
+        STATUS_DELAYED: 1,
+        STATUS_ENQUEUED: 2,
+        STATUS_RUNNING: 3,
+        STATUS_FAILED: 4,
+        STATUS_DONE: 4,
+        STATUS_SKIPPED: 4,
+    }
+    # Fields that are only changed through state transitions by the
+    # middleware and can't be changed by saving a task; see `save`.
+    STATE_FIELDS = [
+        'status',
+        'version',
+        'heartbeat',
+    ]
+    # Fields needed to render a task with the default template.
+    DISPLAY_FIELDS = [
+        'status',
+        'description',
+        'progress',
+    ]
 
     message_id = models.UUIDField(unique=True)
     message_data = models.BinaryField()
@@ -136,6 +380,9 @@ class Task(models.Model):
     model_name = models.CharField(max_length=255, blank=True, null=True)
     app_name = models.CharField(max_length=255, blank=True, null=True)
     results = models.JSONField(blank=True, null=True)
+    # When True, `results` only holds a summary and the full results are
+    # stored in a related `TaskResults` object. Use `get_results()`.
+    results_offloaded = models.BooleanField(default=False)
 
     progress = models.IntegerField(
         validators=[
@@ -144,6 +391,10 @@ class Task(models.Model):
         ],
         default=0,
     )
+    # Increases with every state transition; see `get_version`.
+    version = models.PositiveIntegerField(default=0)
+    # Refreshed periodically by the worker while the task is running.
+    heartbeat = models.DateTimeField(null=True, blank=True)
     created_date = models.DateTimeField(auto_now_add=True)
     last_modified = models.DateTimeField(auto_now=True, db_index=True)
 
@@ -153,12 +404,55 @@ class Task(models.Model):
     class Meta:
         ordering = ['-last_modified']
         default_permissions = []
+        indexes = [
+            # Used by the change feed and keyset pagination.
+            models.Index(
+                fields=['last_modified', 'id'],
+                name='taskstate_task_changed_idx',
+            ),
+        ]
 
 
     def __str__(self):
         return str(self.message)
 
 
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._set_loaded_state()
+        return instance
+
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self._set_loaded_state(fields)
+
+
+    def _set_loaded_state(self, fields=None):
+        """
+        Remembers the values of the state fields as they are in the
+        database so that `save` can tell if they were changed. Only the
+        values of `fields` are updated if it's given.
+        """
+        deferred_fields = self.get_deferred_fields()
+        loaded_state = getattr(self, '_loaded_state', {})
+        for name in self.STATE_FIELDS:
+            if name in deferred_fields:
+                continue
+            if fields is None or name in fields:
+                loaded_state[name] = getattr(self, name)
+        self._loaded_state = loaded_state
+
+
+    def get_changed_state_fields(self):
+        loaded_state = getattr(self, '_loaded_state', {})
+        return [
+            name for name, value in loaded_state.items()
+            if getattr(self, name) != value
+        ]
+
+
     @cached_property
     def message(self):
         return Message.decode(bytes(self.message_data))
@@ -171,12 +465,75 @@ class Task(models.Model):
         return False
 
 
+    @classmethod
+    def get_version(cls, status, attempt=0):
+        """
+        Returns the version of a task with `status` during the given attempt
+        to process its message (the number of retries). Versions increase
+        with every status in `STATUS_ORDER` and with every retry, so that
+        `failed` during the first attempt is older than `delayed` when the
+        message is retried.
+        """
+        return attempt * 10 + cls.STATUS_ORDER[status]
+
+
+    def set_results(self, results, summary=None):
+        """
+        Saves the results of the task. Results larger than
+        `TASKSTATE_RESULTS_MAX_INLINE_SIZE` are stored in a separate table
+        so that they are not loaded every time the task is fetched; in
+        that case `results` is set to a dict with the size of the results
+        and the optional `summary`.
+        """
+        # Measured the same way as `JSONField` encodes the results.
+        size = len(json.dumps(results).encode('utf-8'))
+        max_inline_size = getattr(
+            settings,
+            'TASKSTATE_RESULTS_MAX_INLINE_SIZE',
+            16384,
+        )
+        db = routers.get_write_database()
+        with transaction.atomic(using=db):
+            if size > max_inline_size:
+                TaskResults.objects.using(db).update_or_create(
+                    task=self,
+                    defaults={'data': results},
+                )
+                self.results = {
+                    'size': size,
+                    'summary': summary,
+                }
+                self.results_offloaded = True
+            else:
+                if self.results_offloaded:
+                    TaskResults.objects.using(db).filter(task=self).delete()
+                self.results = results
+                self.results_offloaded = False
+            self.save(
+                update_fields=['results', 'results_offloaded', 'last_modified'],
+                using=db,
+            )
+
+
+    def get_results(self):
+        """
+        Returns the full results of the task, fetching them from the
+        `TaskResults` table if they were too large to store inline.
+        """
+        if not self.results_offloaded:
+            return self.results
+        try:
+            return self.stored_results.data
+        except TaskResults.DoesNotExist:
+            return None
+
+
     @staticmethod
     def set_seen_tasks(pk_list):
         if not isinstance(pk_list, list):
             raise TypeError('pk_list must be of type list')
 
-        task_list = Task.objects.filter(
+        task_list = Task.objects.for_write().filter(
             pk__in=pk_list,
             seen=False,
             status__in=Task.COMPLETE_STATUSES,
@@ -191,12 +548,60 @@ class Task(models.Model):
         if self.seen or self.seen_at:
             if not self.is_complete:
                 raise ValueError('Only completed tasks can be marked as seen')
+        # The state fields are managed by the middleware with conditional
+        # updates. Saving a task to update its progress must not overwrite
+        # a newer status.
+        if (
+            not self._state.adding
+            and kwargs.get('update_fields') is None
+            and not kwargs.get('force_insert')
+        ):
+            changed_fields = self.get_changed_state_fields()
+            if changed_fields:
+                raise ValueError(
+                    'The {0} of a task can only be changed by the '
+                    'middleware'.format(', '.join(changed_fields))
+                )
+            deferred_fields = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.STATE_FIELDS
+                and field.attname not in deferred_fields
+            ]
+        # Tasks fetched from a read replica must still be saved to the
+        # write database.
+        if kwargs.get('using') is None:
+            kwargs['using'] = routers.get_write_database()
         super().save(*args, **kwargs)
+        routers.pin()
+        self._set_loaded_state(kwargs.get('update_fields'))
+
+
+
+
+class TaskResults(models.Model):
+    """
+    Holds the results of a task when they are too large to be stored
+    inline on the `Task` object. See `Task.set_results()`.
+    """
+    task = models.OneToOneField(
+        Task,
+        on_delete=models.CASCADE,
+        related_name='stored_results',
+    )
+    data = models.JSONField(blank=True, null=True)
+
+    class Meta:
+        default_permissions = []
+
+    def __str__(self):
+        return str(self.task_id)
 
 
 
 
-class ChannelManager(models.Manager):
+class ChannelManager(RoutedManagerMixin, models.Manager.from_queryset(RoutedQuerySet)):
 
     def delete_old(self, max_age=604800):
         """
@@ -204,7 +609,7 @@ class ChannelManager(models.Manager):
         argument value which is 604800 seconds by default. 604800 seconds
         is equal to 7 days.
         """
-        channels = self.filter(
+        channels = self.for_write().filter(
             created_date__lte=timezone.now() - timedelta(seconds=max_age)
         )
         channels.delete()
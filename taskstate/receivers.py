@@ -11,19 +11,41 @@ from taskstate.models import Task, Channel
 
 
 
-def send_to_channel(task):
+def send_to_channel(task, status_changed=False):
     """
     A task was updated by Dramatiq's middleware.
     This sends the task to the relevant channel (django-channels) websocket.
+    If the status of the task changed, the consumer will include the
+    results of the task if it's complete.
     """
-    channels = Channel.objects.filter(
-        task_pk_list__contains=[task.pk],
+    send_task_update(
+        task.pk,
+        last_modified=task.last_modified,
+        status_changed=status_changed,
     )
+
+
+def send_task_update(pk, last_modified=None, status_changed=False):
+    """
+    Notifies the channels (django-channels) that are watching the task with
+    primary key `pk` that it changed.
+
+    The `last_modified` value of the task is sent along so that the
+    consumer can tell if the read database has caught up with the change.
+    """
+    channels = Channel.objects.for_read().filter(
+        task_pk_list__contains=[pk],
+    )
+    if last_modified is not None:
+        last_modified = last_modified.isoformat()
     channel_layer = get_channel_layer()
     for channel in channels:
         async_to_sync(channel_layer.send)(channel.name, {
             'type': 'task.status.update',
             'pk_list': channel.task_pk_list,
+            'changed_pk': pk,
+            'last_modified': last_modified,
+            'status_changed': status_changed,
         })
 
 
@@ -42,4 +64,4 @@ def handle_task_saved(sender, instance, created, **kwargs):
 
 @receiver(task_changed, sender=StateMiddleware)
 def handle_task_changed(sender, task, **kwargs):
-    send_to_channel(task)
+    send_to_channel(task, status_changed=True)
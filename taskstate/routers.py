@@ -0,0 +1,160 @@
+"""
+Database routing for taskstate.
+
+By default all taskstate queries use the tasks database of `django_dramatiq`.
+Set `TASKSTATE_READ_DATABASE` to send reads (dashboards, websocket resyncs,
+etc) to a replica instead. Writes use `TASKSTATE_WRITE_DATABASE`, which
+defaults to the tasks database.
+
+Replicas lag behind the primary so reads are sent to the write database
+for `TASKSTATE_REPLICA_LAG` seconds after a write in the same thread (or
+async context). To do the same for the next requests of the same client,
+add `PinningMiddleware` to `MIDDLEWARE`, which keeps track of writes in the
+client's session.
+"""
+
+import time
+
+from asgiref.local import Local
+from django.conf import settings
+from django_dramatiq.apps import DjangoDramatiqConfig
+
+
+_local = Local()
+
+SESSION_KEY = '_taskstate_pinned_until'
+
+
+
+
+def get_write_database():
+    write_database = getattr(settings, 'TASKSTATE_WRITE_DATABASE', None)
+    if write_database is None:
+        return DjangoDramatiqConfig.tasks_database()
+    return write_database
+
+
+def get_read_database():
+    read_database = getattr(settings, 'TASKSTATE_READ_DATABASE', None)
+    if read_database is None or is_pinned():
+        return get_write_database()
+    return read_database
+
+
+def get_replica_lag():
+    return getattr(settings, 'TASKSTATE_REPLICA_LAG', 5)
+
+
+def pin(seconds=None):
+    """
+    Send reads to the write database for the next `seconds` seconds in the
+    current thread or async context. `seconds` defaults to the
+    `TASKSTATE_REPLICA_LAG` setting.
+    """
+    if seconds is None:
+        seconds = get_replica_lag()
+    _local.pinned_until = time.monotonic() + seconds
+
+
+def unpin():
+    _local.pinned_until = 0
+
+
+def is_pinned():
+    pinned_until = getattr(_local, 'pinned_until', 0)
+    return pinned_until > time.monotonic()
+
+
+def pin_session(session):
+    """
+    Send the reads of the client with this session to the write database
+    for the next `TASKSTATE_REPLICA_LAG` seconds (see `PinningMiddleware`).
+    """
+    session[SESSION_KEY] = time.time() + get_replica_lag()
+
+
+def pin_from_session(session):
+    """
+    Pins the reads in the current thread or async context if the session
+    was pinned with `pin_session` in the last `TASKSTATE_REPLICA_LAG`
+    seconds.
+    """
+    seconds = session.get(SESSION_KEY, 0) - time.time()
+    if seconds > 0:
+        pin(seconds)
+
+
+
+
+class TaskstateRouter:
+    """
+    A database router for the taskstate app. Add it to `DATABASE_ROUTERS`
+    when using a read replica so that saving a task that was fetched from
+    the replica writes to the write database:
+    ```
+    DATABASE_ROUTERS = ['taskstate.routers.TaskstateRouter']
+    ```
+    """
+    app_label = 'taskstate'
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            return get_read_database()
+        return None
+
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label == self.app_label:
+            pin()
+            return get_write_database()
+        return None
+
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label != self.app_label:
+            return None
+        read_database = getattr(settings, 'TASKSTATE_READ_DATABASE', None)
+        if read_database is not None and read_database != get_write_database():
+            if db == read_database:
+                return False
+        return None
+
+
+
+
+class PinningMiddleware:
+    """
+    Sends the reads of a request to the write database when the same client
+    wrote to the tasks database in the last `TASKSTATE_REPLICA_LAG` seconds,
+    for example by marking tasks as seen. Writes are remembered in the
+    session, so this must come after `SessionMiddleware`:
+    ```
+    MIDDLEWARE = [
+        # ...
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        # ...
+        'taskstate.routers.PinningMiddleware',
+    ]
+    ```
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+
+    def __call__(self, request):
+        # A pin from the previous request served by this thread must not
+        # apply to a request of another client.
+        unpin()
+        session = getattr(request, 'session', None)
+        if session is not None:
+            pin_from_session(session)
+        pinned_until = getattr(_local, 'pinned_until', 0)
+        try:
+            response = self.get_response(request)
+            if session is not None:
+                if getattr(_local, 'pinned_until', 0) > pinned_until:
+                    pin_session(session)
+        finally:
+            unpin()
+        return response
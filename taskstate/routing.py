@@ -1,6 +1,6 @@
 """
 URL routing for django-channels consumers.
-Path's must be prefixed with `ws/`.
+Websocket path's must be prefixed with `ws/`.
 """
 
 from django.urls import re_path
@@ -11,4 +11,10 @@ from . import consumers
 websocket_urlpatterns = [
     re_path(r'^ws/get-task-status/$', consumers.CheckTaskStatus.as_asgi()),
     re_path(r'^ws/set-task-seen/$', consumers.SetTaskSeen.as_asgi()),
+    re_path(r'^ws/get-task-results/$', consumers.GetTaskResults.as_asgi()),
+]
+
+
+http_urlpatterns = [
+    re_path(r'^taskstate/task-status/stream/$', consumers.TaskStatusStream.as_asgi()),
 ]
@@ -0,0 +1,152 @@
+"""
+Lightweight serialization of tasks for clients (websockets, templates, etc).
+
+These work on the dictionaries returned by `Task.objects.values()` rather
+than on full `Task` instances so that only the fields that are actually
+sent to a client are fetched from the database. If `orjson` is installed
+it will be used to encode the payload, otherwise the standard library
+`json` module is used.
+
+Results are only sent for complete tasks, and only when they are asked for
+with `results_for`: in the first message a client receives for a task and
+in the message sent when the task completes, but not in any later status
+updates of other tasks. Results that were too large to be stored inline are
+not sent at all; instead `results` contains a summary and
+`results_offloaded` is true so that the client can fetch them separately
+(see `taskstate.consumers.GetTaskResults`).
+"""
+
+import json
+from operator import itemgetter
+
+try:
+    import orjson
+except ImportError: # pragma: no cover
+    orjson = None
+
+from taskstate.models import Task, encode_cursor
+
+
+# The fields fetched from the database for each task sent to a client.
+TASK_VALUES_FIELDS = (
+    'pk',
+    'status',
+    'progress',
+    'description',
+    'results',
+    'results_offloaded',
+    'version',
+    'last_modified',
+)
+
+_get_cursor_values = itemgetter('last_modified', 'pk')
+
+
+
+
+def dumps(obj):
+    """
+    Encode `obj` as a JSON string using the fastest encoder available.
+    Falls back to the `json` module for values `orjson` can't encode,
+    like integers larger than 64 bits.
+    """
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode('utf-8')
+        except orjson.JSONEncodeError:
+            pass
+    return json.dumps(obj, separators=(',', ':'))
+
+
+# Must be kept in the same order as the unpacking in `serialize_task`.
+_get_task_values = itemgetter(
+    'pk',
+    'status',
+    'progress',
+    'description',
+    'results',
+    'results_offloaded',
+    'version',
+)
+
+
+def serialize_task(values, include_results=False):
+    """
+    Return the client representation of a single task from a dictionary
+    of task values (see `TASK_VALUES_FIELDS`). Results are only included
+    if `include_results` is true and the task is complete.
+    """
+    (
+        pk, status, progress, description, results, results_offloaded,
+        version,
+    ) = _get_task_values(values)
+    if not include_results or status not in Task.COMPLETE_STATUSES:
+        results = None
+        results_offloaded = False
+    return {
+        'id': pk,
+        'pk': pk,
+        'status': status,
+        'progress': progress or '',
+        'description': description or '',
+        'results': results,
+        'results_offloaded': results_offloaded,
+        'version': version,
+    }
+
+
+def serialize_tasks(values_list, cursor=None, results_for=()):
+    """
+    Return the payload for a list of task value dictionaries. The results
+    of the tasks with primary keys in `results_for` are included.
+
+    The payload includes a cursor for the most recent change in the list
+    which clients can send back to only receive tasks that changed since
+    (see `TaskQuerySet.changed_since`). `cursor` is returned as is when the
+    list is empty.
+    """
+    values_list = list(values_list)
+    results_for = set(results_for)
+    if values_list:
+        cursor = encode_cursor(*max(map(_get_cursor_values, values_list)))
+    return {
+        'tasks': [
+            serialize_task(values, include_results=values['pk'] in results_for)
+            for values in values_list
+        ],
+        'cursor': cursor,
+    }
+
+
+def serialize_results(values_list):
+    """
+    Return the full results for a list of dictionaries containing the `pk`,
+    `results`, `results_offloaded` and `stored_results__data` values of
+    completed tasks.
+    """
+    return {
+        'results': [
+            {
+                'id': values['pk'],
+                'pk': values['pk'],
+                'results': (
+                    values['stored_results__data']
+                    if values['results_offloaded']
+                    else values['results']
+                ),
+            }
+            for values in values_list
+        ],
+    }
+
+
+def dumps_tasks(values_list, cursor=None, results_for=()):
+    """
+    Return the JSON payload that is sent to clients for a list of
+    task value dictionaries.
+    """
+    return dumps(serialize_tasks(
+        values_list,
+        cursor=cursor,
+        results_for=results_for,
+    ))
@@ -9,6 +9,12 @@
     // The task_set contains all the task id's that
     // we want to request statuses of
     const task_set = new Set();
+    // The cursor from the last status message. Sending it back to the
+    // server means that only tasks that changed since will be returned.
+    let cursor = null;
+    // The latest version of each task received. Messages can arrive out of
+    // order, so older versions of a task are ignored.
+    const task_versions = new Map();
 
     const ws = {};
     if (window.location.protocol == 'https:')
@@ -26,35 +32,63 @@
         return;
     }
 
-    let socket = undefined;
-    let task_seen_socket = undefined;
-    try
-    {
-        socket = new WebSocket(
-            ws.scheme
-            + window.location.host
-            + '/ws/get-task-status/'
-        );
-    }
-    catch (e)
-    {
-        // Either the user has no tasks (maybe only old tasks shown in UI)
-        // or is not logged in
-        return;
-    }
-    try
-    {
-        task_seen_socket = new WebSocket(
-            ws.scheme
-            + window.location.host
-            + '/ws/set-task-seen/'
-        );
-    }
-    catch (e)
+    // Seconds to wait before reconnecting a closed socket. Doubles after
+    // every failed attempt up to the maximum.
+    const reconnect_delay = {
+        'initial': 1,
+        'max': 30,
+    };
+
+    /**
+     * Opens a websocket to `path` and reopens it when it is closed while
+     * there are still active tasks. `on_open` is called every time the
+     * socket is (re)opened.
+     */
+    function open_socket(path, on_open, on_message)
     {
-        // Either the user has no tasks (maybe only old tasks shown in UI)
-        // or is not logged in
-        return;
+        const handle = {
+            'socket': undefined,
+            'delay': reconnect_delay.initial,
+        };
+
+        function connect()
+        {
+            try
+            {
+                handle.socket = new WebSocket(
+                    ws.scheme
+                    + window.location.host
+                    + path
+                );
+            }
+            catch (e)
+            {
+                // Either the user has no tasks (maybe only old tasks shown in UI)
+                // or is not logged in
+                return;
+            }
+            handle.socket.onopen = (event) =>
+            {
+                handle.delay = reconnect_delay.initial;
+                on_open(handle.socket);
+            }
+            if (on_message)
+            {
+                handle.socket.onmessage = on_message;
+            }
+            handle.socket.onclose = (event) =>
+            {
+                if (! document.querySelector('.task-status.active'))
+                {
+                    return;
+                }
+                window.setTimeout(connect, handle.delay * 1000);
+                handle.delay = Math.min(handle.delay * 2, reconnect_delay.max);
+            }
+        }
+
+        connect();
+        return handle;
     }
 
 
@@ -82,27 +116,23 @@
 
     function send_payload(_socket)
     {
+        if (! _socket || _socket.readyState !== WebSocket.OPEN)
+        {
+            // The payload is sent again when the socket is reopened.
+            return;
+        }
         const payload = JSON.stringify({
             'pk_list': Array.from(task_set),
+            'cursor': cursor,
         });
         _socket.send(payload);
     }
 
-    task_seen_socket.onopen = (event) =>
-    {
-        send_payload(task_seen_socket);
-    }
-
-
-    socket.onopen = (event) =>
-    {
-        send_payload(socket);
-    }
-
-    socket.onmessage = (event) =>
+    function on_status_message(event)
     {
         const response = JSON.parse(event.data);
         const tasks_returned = response.tasks;
+        cursor = response.cursor;
 
         for (let i = 0; i < tasks_returned.length; i++)
         {
@@ -110,6 +140,12 @@
             const pk = task.pk;
             const status = task.status;
 
+            if (task_versions.get(pk) > task.version)
+            {
+                continue;
+            }
+            task_versions.set(pk, task.version);
+
             const selector = '.task-status[data-pk="' + pk.toString() + '"]';
             const task_element = document.querySelector(selector);
             const task_status = task_element.querySelector('.task-status-text');
@@ -119,7 +155,7 @@
                 // Let the server know that these tasks have been seen after
                 // completing. The server will automatically set all tasks to
                 // the correct seen status.
-                send_payload(task_seen_socket);
+                send_payload(task_seen.socket);
             }
             task_status.textContent = status;
             task_element.dataset.status = status;
@@ -134,4 +170,9 @@
             }
         }
     }
+
+    // After reconnecting, the cursor from the last message is sent so that
+    // only the tasks that changed while disconnected are returned.
+    const task_seen = open_socket('/ws/set-task-seen/', send_payload);
+    open_socket('/ws/get-task-status/', send_payload, on_status_message);
 }());
@@ -1,6 +1,8 @@
 import dramatiq
 
+from taskstate.middleware import StateMiddleware
 from taskstate.models import Task
+from taskstate.signals import task_changed
 
 
 @dramatiq.actor(max_retries=0)
@@ -8,4 +10,18 @@ def cleanup_tasks():
     Task.objects.delete_old(max_task_age=120)
     Task.objects.delete_old(max_task_age=120, only_if_seen=False)
     Task.objects.delete_stale()
+    fail_dead_tasks()
     return
+
+
+@dramatiq.actor(max_retries=0)
+def fail_dead_tasks():
+    """
+    Marks running tasks whose worker has died as failed and notifies
+    subscribers through the `task_changed` signal.
+    """
+    for task in Task.objects.fail_dead():
+        task_changed.send(
+            sender=StateMiddleware,
+            task=task,
+        )
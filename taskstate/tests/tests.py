@@ -1 +1,952 @@
-from django.test import TestCase
+import json
+import uuid
+from datetime import timedelta
+from io import StringIO
+from unittest import mock
+
+from asgiref.sync import async_to_sync
+from asgiref.testing import ApplicationCommunicator
+from channels.layers import get_channel_layer
+from channels.db import database_sync_to_async
+from dramatiq import Message
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management import CommandError, call_command
+from django.db import DatabaseError, connections, transaction
+from django.http import HttpResponse
+from django.utils import timezone
+from django.test import (
+    RequestFactory,
+    SimpleTestCase,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+
+from taskstate import routers, views
+from taskstate.consumers import CheckTaskStatus, SetTaskSeen, TaskStatusStream
+from taskstate.middleware import CurrentTask, StateMiddleware
+from taskstate.models import (
+    DATABASE_LABEL,
+    Channel,
+    Task,
+    TaskQuerySet,
+    TaskResults,
+    decode_cursor,
+    encode_cursor,
+)
+from taskstate.receivers import send_to_channel
+from taskstate.routers import PinningMiddleware, TaskstateRouter
+from taskstate.serializers import TASK_VALUES_FIELDS, dumps, serialize_tasks
+from taskstate.signals import task_changed
+from taskstate.tasks import fail_dead_tasks
+
+
+
+
+class RouterTestCase(SimpleTestCase):
+
+    def setUp(self):
+        routers.unpin()
+
+    def tearDown(self):
+        routers.unpin()
+
+
+    @override_settings(TASKSTATE_READ_DATABASE=None, TASKSTATE_WRITE_DATABASE=None)
+    def test_defaults_to_tasks_database(self):
+        self.assertEqual(routers.get_write_database(), DATABASE_LABEL)
+        self.assertEqual(routers.get_read_database(), DATABASE_LABEL)
+
+
+    @override_settings(TASKSTATE_READ_DATABASE='replica')
+    def test_reads_use_read_database(self):
+        self.assertEqual(routers.get_read_database(), 'replica')
+        self.assertEqual(Task.objects.for_read().db, 'replica')
+        self.assertEqual(Task.objects.for_display().db, 'replica')
+
+
+    @override_settings(
+        TASKSTATE_READ_DATABASE='replica',
+        TASKSTATE_WRITE_DATABASE='default',
+    )
+    def test_writes_use_write_database(self):
+        self.assertEqual(Task.objects.for_write().db, 'default')
+
+
+    @override_settings(TASKSTATE_READ_DATABASE='replica', TASKSTATE_REPLICA_LAG=60)
+    def test_reads_pinned_after_write(self):
+        Task.objects.for_write()
+        self.assertFalse(routers.is_pinned())
+        routers.pin()
+        self.assertTrue(routers.is_pinned())
+        self.assertEqual(routers.get_read_database(), DATABASE_LABEL)
+        routers.unpin()
+        self.assertEqual(routers.get_read_database(), 'replica')
+
+
+    @override_settings(TASKSTATE_READ_DATABASE='replica', TASKSTATE_REPLICA_LAG=0)
+    def test_pin_expires(self):
+        routers.pin()
+        self.assertFalse(routers.is_pinned())
+        self.assertEqual(routers.get_read_database(), 'replica')
+
+
+    @override_settings(TASKSTATE_READ_DATABASE='replica')
+    def test_router(self):
+        router = TaskstateRouter()
+        User = get_user_model()
+        self.assertEqual(router.db_for_read(Task), 'replica')
+        self.assertEqual(router.db_for_write(Task), DATABASE_LABEL)
+        self.assertIsNone(router.db_for_read(User))
+        self.assertIsNone(router.db_for_write(User))
+        self.assertFalse(router.allow_migrate('replica', 'taskstate'))
+        self.assertIsNone(router.allow_migrate(DATABASE_LABEL, 'taskstate'))
+        self.assertIsNone(router.allow_migrate('replica', 'auth'))
+
+
+
+
+@override_settings(TASKSTATE_READ_DATABASE='replica', TASKSTATE_REPLICA_LAG=60)
+class PinningTestCase(TestCase):
+
+    def setUp(self):
+        routers.unpin()
+
+    def tearDown(self):
+        routers.unpin()
+
+
+    def get_response(self, write=False):
+        databases = []
+
+        def view(request):
+            databases.append(routers.get_read_database())
+            if write:
+                routers.pin()
+            return HttpResponse()
+
+        request = RequestFactory().get('/')
+        request.session = self.session
+        PinningMiddleware(view)(request)
+        return databases[0]
+
+
+    def test_pin_does_not_leak_to_next_request(self):
+        self.session = {}
+        routers.pin()
+        self.assertEqual(self.get_response(), 'replica')
+        self.assertFalse(routers.is_pinned())
+
+
+    def test_pinned_after_write_in_session(self):
+        self.session = {}
+        self.assertEqual(self.get_response(write=True), 'replica')
+        self.assertFalse(routers.is_pinned())
+        self.assertEqual(self.get_response(), DATABASE_LABEL)
+
+        other_session = self.session
+        self.session = {}
+        self.assertEqual(self.get_response(), 'replica')
+        self.session = other_session
+        with override_settings(TASKSTATE_REPLICA_LAG=0):
+            routers.pin_session(self.session)
+        self.assertEqual(self.get_response(), 'replica')
+
+
+    def test_set_task_seen_pins_session(self):
+        task = create_task(status=Task.STATUS_DONE)
+        consumer = SetTaskSeen()
+        consumer.scope = {'session': SessionStore()}
+        consumer.receive(json.dumps({'pk_list': [task.pk]}))
+        self.assertTrue(Task.objects.get(pk=task.pk).seen)
+        routers.unpin()
+        session = SessionStore(consumer.scope['session'].session_key)
+        routers.pin_from_session(session)
+        self.assertTrue(routers.is_pinned())
+
+
+
+
+@override_settings(
+    TASKSTATE_READ_DATABASE='replica',
+    TASKSTATE_WRITE_DATABASE='default',
+    TASKSTATE_REPLICA_LAG=0,
+)
+class ReplicaTestCase(TransactionTestCase):
+    """
+    Requires a `replica` database alias that mirrors the `default`
+    database in the test settings. A `TransactionTestCase` is used so that
+    rows written through `default` are visible to the `replica` connection.
+    """
+    databases = {'default', 'replica'}
+
+    def setUp(self):
+        routers.unpin()
+
+    def tearDown(self):
+        routers.unpin()
+
+
+    def create_task(self, **kwargs):
+        return Task.objects.for_write().create(
+            message_id=uuid.uuid4(),
+            message_data=b'',
+            **kwargs
+        )
+
+
+    def test_read_from_replica(self):
+        task = self.create_task()
+        task = Task.objects.for_read().get(pk=task.pk)
+        self.assertEqual(task._state.db, 'replica')
+
+
+    def test_save_uses_write_database(self):
+        task = self.create_task()
+        task = Task.objects.for_read().get(pk=task.pk)
+        task.progress = 55
+        task.save()
+        self.assertEqual(task._state.db, 'default')
+        self.assertEqual(Task.objects.for_write().get(pk=task.pk).progress, 55)
+
+
+    @override_settings(TASKSTATE_REPLICA_LAG=60)
+    def test_reads_pinned_after_write(self):
+        task = self.create_task()
+        routers.unpin()
+        Task.objects.for_write().filter(pk=task.pk)
+        self.assertFalse(routers.is_pinned())
+        Task.objects.for_write().filter(pk=task.pk).update(progress=10)
+        self.assertTrue(routers.is_pinned())
+        routers.unpin()
+        task.progress = 20
+        task.save()
+        self.assertTrue(routers.is_pinned())
+
+
+    def test_status_update_from_stale_replica(self):
+        User = get_user_model()
+        user = User.objects.create_user('replica')
+        task = self.create_task(user=user, status=Task.STATUS_RUNNING)
+        consumer = CheckTaskStatus()
+        consumer.user = user
+        sent = []
+        consumer.send = lambda text_data: sent.append(json.loads(text_data))
+
+        # Keep the replica connection on a snapshot from before the task is
+        # completed by another process, like a lagging replica.
+        with transaction.atomic(using='replica'):
+            with connections['replica'].cursor() as cursor:
+                cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+            Task.objects.for_read().get(pk=task.pk)
+            Task.objects.for_write().filter(pk=task.pk).update(
+                status=Task.STATUS_DONE,
+                last_modified=timezone.now(),
+            )
+            routers.unpin()
+            self.assertEqual(
+                Task.objects.for_read().get(pk=task.pk).status,
+                Task.STATUS_RUNNING,
+            )
+            task = Task.objects.for_write().get(pk=task.pk)
+            consumer.task_status_update({
+                'type': 'task.status.update',
+                'pk_list': [task.pk],
+                'changed_pk': task.pk,
+                'last_modified': task.last_modified.isoformat(),
+                'status_changed': True,
+            })
+
+        self.assertEqual(sent[0]['tasks'][0]['status'], Task.STATUS_DONE)
+
+
+
+
+def create_task(**kwargs):
+    kwargs.setdefault('message_id', uuid.uuid4())
+    kwargs.setdefault('message_data', b'')
+    return Task.objects.for_write().create(**kwargs)
+
+
+
+
+class ResultsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+
+
+    @override_settings(TASKSTATE_RESULTS_MAX_INLINE_SIZE=100)
+    def test_small_results_stored_inline(self):
+        task = create_task(status=Task.STATUS_DONE)
+        task.set_results({'rows': 1})
+        task = Task.objects.get(pk=task.pk)
+        self.assertFalse(task.results_offloaded)
+        self.assertEqual(task.results, {'rows': 1})
+        self.assertEqual(task.get_results(), {'rows': 1})
+        self.assertFalse(TaskResults.objects.exists())
+
+
+    @override_settings(TASKSTATE_RESULTS_MAX_INLINE_SIZE=100)
+    def test_large_results_offloaded(self):
+        task = create_task(status=Task.STATUS_DONE)
+        results = list(range(100))
+        task.set_results(results, summary='100 rows')
+        task = Task.objects.get(pk=task.pk)
+        self.assertTrue(task.results_offloaded)
+        self.assertEqual(task.results['summary'], '100 rows')
+        self.assertGreater(task.results['size'], 100)
+        self.assertEqual(task.get_results(), results)
+
+        task.set_results([1])
+        task = Task.objects.get(pk=task.pk)
+        self.assertFalse(task.results_offloaded)
+        self.assertEqual(task.get_results(), [1])
+        self.assertFalse(TaskResults.objects.exists())
+
+
+    def test_results_json_compatible(self):
+        task = create_task(status=Task.STATUS_DONE)
+        task.set_results({1: 'one', 'big': 2 ** 70})
+        task = Task.objects.get(pk=task.pk)
+        self.assertEqual(task.get_results(), {'1': 'one', 'big': 2 ** 70})
+        self.assertIn(str(2 ** 70), dumps({1: 2 ** 70}))
+
+
+    @override_settings(TASKSTATE_RESULTS_MAX_INLINE_SIZE=10)
+    def test_results_not_offloaded_if_save_fails(self):
+        task = create_task(status=Task.STATUS_DONE)
+        with mock.patch.object(Task, 'save', side_effect=DatabaseError):
+            with self.assertRaises(DatabaseError):
+                task.set_results(list(range(100)))
+        self.assertFalse(TaskResults.objects.exists())
+        self.assertFalse(Task.objects.get(pk=task.pk).results_offloaded)
+
+
+    def test_results_only_sent_when_asked_for(self):
+        done = create_task(status=Task.STATUS_DONE, results=[1])
+        running = create_task(status=Task.STATUS_RUNNING, results=[2])
+        values_list = Task.objects.filter(
+            pk__in=[done.pk, running.pk],
+        ).values(*TASK_VALUES_FIELDS)
+
+        payload = serialize_tasks(values_list)
+        self.assertEqual([task['results'] for task in payload['tasks']], [None, None])
+
+        payload = serialize_tasks(values_list, results_for=[done.pk, running.pk])
+        results = {task['pk']: task['results'] for task in payload['tasks']}
+        # Results of incomplete tasks are never sent.
+        self.assertEqual(results, {done.pk: [1], running.pk: None})
+
+
+    def test_consumer_sends_results_once(self):
+        first = create_task(status=Task.STATUS_DONE, results=[1], user=self.user)
+        second = create_task(status=Task.STATUS_RUNNING, user=self.user)
+        consumer = CheckTaskStatus()
+        consumer.user = self.user
+        sent = []
+        consumer.send = lambda text_data: sent.append(json.loads(text_data))
+
+        consumer.task_status_update({
+            'pk_list': [first.pk, second.pk],
+            'changed_pk': first.pk,
+            'status_changed': True,
+        })
+        Task.objects.filter(pk=second.pk).update(status=Task.STATUS_DONE, results=[2])
+        consumer.task_status_update({
+            'pk_list': [first.pk, second.pk],
+            'changed_pk': second.pk,
+            'status_changed': True,
+        })
+        results = [
+            {task['pk']: task['results'] for task in payload['tasks']}
+            for payload in sent
+        ]
+        self.assertEqual(results, [
+            {first.pk: [1], second.pk: None},
+            {first.pk: None, second.pk: [2]},
+        ])
+
+
+
+
+class TaskStatusStreamTestCase(TransactionTestCase):
+    """
+    Drives the server-sent events consumer through a status change.
+    A `TransactionTestCase` is used because the consumer queries the
+    database from another thread.
+    """
+
+    def get_communicator(self, user, pk_list):
+        query_string = '&'.join('pk={0}'.format(pk) for pk in pk_list)
+        return ApplicationCommunicator(TaskStatusStream.as_asgi(), {
+            'type': 'http',
+            'method': 'GET',
+            'path': '/taskstate/task-status/stream/',
+            'query_string': query_string.encode('ascii'),
+            'headers': [],
+            'user': user,
+        })
+
+
+    async def receive_event(self, communicator):
+        message = await communicator.receive_output(timeout=5)
+        self.assertEqual(message['type'], 'http.response.body')
+        body = message['body'].decode('utf-8')
+        self.assertTrue(body.startswith('data: '))
+        return json.loads(body[len('data: '):])
+
+
+    async def test_stream(self):
+        user = await database_sync_to_async(get_user_model().objects.create)(
+            username='user',
+        )
+        task = await database_sync_to_async(create_task)(
+            status=Task.STATUS_RUNNING,
+            user=user,
+        )
+        communicator = self.get_communicator(user, [task.pk])
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+
+        start = await communicator.receive_output(timeout=5)
+        self.assertEqual(start['status'], 200)
+        self.assertIn((b'Content-Type', b'text/event-stream'), start['headers'])
+
+        payload = await self.receive_event(communicator)
+        self.assertEqual(payload['tasks'][0]['status'], Task.STATUS_RUNNING)
+        self.assertTrue(
+            await database_sync_to_async(
+                Channel.objects.filter(task_pk_list__contains=[task.pk]).exists
+            )()
+        )
+
+        def complete_task():
+            Task.objects.filter(pk=task.pk).update(status=Task.STATUS_DONE)
+            task.status = Task.STATUS_DONE
+            send_to_channel(task, status_changed=True)
+
+        await database_sync_to_async(complete_task)()
+        payload = await self.receive_event(communicator)
+        self.assertEqual(payload['tasks'][0]['status'], Task.STATUS_DONE)
+
+        # The stream ends once all the tasks are complete.
+        end = await communicator.receive_output(timeout=5)
+        self.assertEqual(end, {
+            'type': 'http.response.body',
+            'body': b'',
+            'more_body': False,
+        })
+        await communicator.wait(timeout=5)
+        self.assertFalse(
+            await database_sync_to_async(Channel.objects.exists)()
+        )
+
+
+    async def test_anonymous_user_forbidden(self):
+        communicator = self.get_communicator(AnonymousUser(), [1])
+        await communicator.send_input({'type': 'http.request', 'body': b''})
+        start = await communicator.receive_output(timeout=5)
+        self.assertEqual(start['status'], 403)
+
+
+
+
+class TaskStatusViewTestCase(TestCase):
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        self.task = create_task(status=Task.STATUS_RUNNING, user=self.user)
+
+
+    def get(self, user=None, **extra):
+        request = RequestFactory().get('/', {'pk': [self.task.pk]}, **extra)
+        request.user = user or self.user
+        return views.task_status(request)
+
+
+    def test_not_modified(self):
+        response = self.get()
+        self.assertEqual(response.status_code, 200)
+        payload = json.loads(response.content)
+        self.assertEqual(payload['tasks'][0]['pk'], self.task.pk)
+
+        response = self.get(HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b'')
+
+
+    def test_modified(self):
+        etag = self.get()['ETag']
+        self.task.progress = 50
+        self.task.save()
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+    def test_anonymous_user_forbidden(self):
+        response = self.get(user=AnonymousUser())
+        self.assertEqual(response.status_code, 403)
+
+
+
+
+class ChangeFeedTestCase(TestCase):
+
+    def create_tasks(self, count):
+        # Give all tasks the same `last_modified` value so that the primary
+        # key has to be used as a tie-breaker.
+        for i in range(count):
+            create_task()
+        Task.objects.update(last_modified=timezone.now())
+        return list(Task.objects.order_by('pk'))
+
+
+    def test_cursor(self):
+        last_modified = timezone.now()
+        cursor = encode_cursor(last_modified, 12)
+        self.assertEqual(decode_cursor(cursor), (last_modified, 12))
+
+
+    def test_invalid_cursor(self):
+        for cursor in [None, '', 'not a cursor', encode_cursor(timezone.now(), 1)[:-4]]:
+            with self.assertRaises(ValueError):
+                decode_cursor(cursor)
+
+
+    def test_changed_since(self):
+        tasks = self.create_tasks(4)
+        self.assertEqual(list(Task.objects.changed_since()), tasks)
+
+        cursor = encode_cursor(tasks[1].last_modified, tasks[1].pk)
+        self.assertEqual(list(Task.objects.changed_since(cursor)), tasks[2:])
+
+        Task.objects.filter(pk=tasks[0].pk).update(
+            last_modified=timezone.now() + timedelta(seconds=1),
+        )
+        self.assertEqual(
+            [task.pk for task in Task.objects.changed_since(cursor)],
+            [tasks[2].pk, tasks[3].pk, tasks[0].pk],
+        )
+
+
+    def test_for_display_page(self):
+        tasks = self.create_tasks(5)
+        tasks.reverse()
+
+        page, cursor = Task.objects.for_display_page(limit=2)
+        self.assertEqual(page, tasks[:2])
+        page, cursor = Task.objects.for_display_page(cursor=cursor, limit=2)
+        self.assertEqual(page, tasks[2:4])
+        page, cursor = Task.objects.for_display_page(
+            cursor=cursor,
+            limit=2,
+            fields=Task.DISPLAY_FIELDS,
+        )
+        self.assertEqual(page, tasks[4:])
+        self.assertIsNone(cursor)
+
+
+    def test_consumer_sends_changes_since_cursor(self):
+        user = get_user_model().objects.create(username='user')
+        tasks = [create_task(user=user) for i in range(3)]
+        consumer = CheckTaskStatus()
+        consumer.user = user
+        sent = []
+        consumer.send = lambda text_data: sent.append(json.loads(text_data))
+
+        pk_list = [task.pk for task in tasks]
+        consumer.send_tasks(consumer.get_tasks(pk_list))
+        cursor = sent[-1]['cursor']
+
+        Task.objects.filter(pk=tasks[1].pk).update(
+            status=Task.STATUS_RUNNING,
+            last_modified=timezone.now() + timedelta(seconds=1),
+        )
+        consumer.send_tasks(consumer.get_tasks(pk_list, cursor=cursor), cursor=cursor)
+        self.assertEqual([task['pk'] for task in sent[-1]['tasks']], [tasks[1].pk])
+        new_cursor = sent[-1]['cursor']
+        self.assertNotEqual(new_cursor, cursor)
+
+        # Nothing changed, so the same cursor is returned.
+        consumer.send_tasks(consumer.get_tasks(pk_list, cursor=new_cursor), cursor=new_cursor)
+        self.assertEqual(sent[-1], {'tasks': [], 'cursor': new_cursor})
+
+
+
+
+class StateTransitionTestCase(TestCase):
+
+    def setUp(self):
+        self.middleware = StateMiddleware()
+        self.message = Message(
+            queue_name='default',
+            actor_name='actor',
+            args=(),
+            kwargs={'for_state': {'description': 'Test'}},
+            options={},
+        )
+
+
+    def get_task(self):
+        return Task.objects.get(message_id=self.message.message_id)
+
+
+    def test_get_version(self):
+        versions = [
+            Task.get_version(Task.STATUS_DELAYED),
+            Task.get_version(Task.STATUS_ENQUEUED),
+            Task.get_version(Task.STATUS_RUNNING),
+            Task.get_version(Task.STATUS_DONE),
+        ]
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertEqual(
+            Task.get_version(Task.STATUS_FAILED),
+            Task.get_version(Task.STATUS_DONE),
+        )
+        self.assertGreater(
+            Task.get_version(Task.STATUS_DELAYED, attempt=1),
+            Task.get_version(Task.STATUS_FAILED, attempt=0),
+        )
+
+
+    def test_create_or_update_from_message(self):
+        task = Task.objects.create_or_update_from_message(self.message)
+        self.assertEqual(task.status, Task.STATUS_ENQUEUED)
+        self.assertEqual(task.version, Task.get_version(Task.STATUS_ENQUEUED))
+
+        task = Task.objects.create_or_update_from_message(
+            self.message,
+            status=Task.STATUS_RUNNING,
+            progress=10,
+        )
+        self.assertEqual(task.status, Task.STATUS_RUNNING)
+        self.assertEqual(task.progress, 10)
+
+        # A repeated update with the same version is not applied.
+        task = Task.objects.create_or_update_from_message(
+            self.message,
+            status=Task.STATUS_RUNNING,
+            progress=0,
+        )
+        self.assertEqual(task.progress, 10)
+
+        # A late enqueue can't move a running task back.
+        task = Task.objects.create_or_update_from_message(self.message)
+        self.assertEqual(task.status, Task.STATUS_RUNNING)
+        self.assertEqual(task.version, Task.get_version(Task.STATUS_RUNNING))
+        self.assertEqual(Task.objects.count(), 1)
+
+
+    def test_delayed_message_enqueued_when_due(self):
+        self.middleware.after_enqueue(None, self.message, 1000)
+        self.assertEqual(self.get_task().status, Task.STATUS_DELAYED)
+        self.middleware.after_enqueue(None, self.message, None)
+        self.assertEqual(self.get_task().status, Task.STATUS_ENQUEUED)
+
+
+    def test_retry(self):
+        self.middleware.after_enqueue(None, self.message, None)
+        self.middleware.before_process_message(None, self.message)
+        self.assertEqual(self.get_task().status, Task.STATUS_RUNNING)
+
+        # The Retries middleware enqueues the message again before the
+        # failure of the first attempt is recorded.
+        self.message.options['retries'] = 1
+        self.middleware.after_enqueue(None, self.message, 1000)
+        self.middleware.after_process_message(
+            None,
+            self.message,
+            exception=Exception(),
+        )
+        task = self.get_task()
+        self.assertEqual(task.status, Task.STATUS_DELAYED)
+        self.assertEqual(task.version, Task.get_version(Task.STATUS_DELAYED, 1))
+
+        self.middleware.after_enqueue(None, self.message, None)
+        self.assertEqual(self.get_task().status, Task.STATUS_ENQUEUED)
+        self.middleware.before_process_message(None, self.message)
+        self.middleware.after_process_message(None, self.message)
+        task = self.get_task()
+        self.assertEqual(task.status, Task.STATUS_DONE)
+        self.assertEqual(task.version, Task.get_version(Task.STATUS_DONE, 1))
+
+
+    def test_redelivered_after_fail_dead(self):
+        self.middleware.after_enqueue(None, self.message, None)
+        self.middleware.before_process_message(None, self.message)
+        Task.objects.update(heartbeat=timezone.now() - timedelta(seconds=600))
+        self.assertEqual(len(Task.objects.fail_dead()), 1)
+        self.assertEqual(self.get_task().status, Task.STATUS_FAILED)
+
+        # The broker redelivers the message without increasing its retries.
+        self.middleware.before_process_message(None, self.message)
+        self.middleware.after_process_message(None, self.message)
+        task = self.get_task()
+        self.assertEqual(task.status, Task.STATUS_DONE)
+        self.assertEqual(task.version, Task.get_version(Task.STATUS_DONE))
+
+
+    def test_save_does_not_change_state(self):
+        task = Task.objects.create_or_update_from_message(self.message)
+        task.progress = 50
+        task.save()
+        self.assertEqual(self.get_task().progress, 50)
+
+        task.status = Task.STATUS_DONE
+        with self.assertRaises(ValueError):
+            task.save()
+        task.refresh_from_db()
+        self.assertEqual(task.status, Task.STATUS_ENQUEUED)
+        task.save()
+
+
+
+
+class HeartbeatTestCase(TestCase):
+
+    def create_running_task(self, heartbeat_age=None):
+        heartbeat = None
+        if heartbeat_age is not None:
+            heartbeat = timezone.now() - timedelta(seconds=heartbeat_age)
+        return create_task(status=Task.STATUS_RUNNING, heartbeat=heartbeat)
+
+
+    def test_update_heartbeats(self):
+        tasks = [self.create_running_task(heartbeat_age=600) for i in range(3)]
+        before = timezone.now()
+        with self.assertNumQueries(1):
+            Task.objects.update_heartbeats([task.pk for task in tasks])
+        for task in Task.objects.all():
+            self.assertGreaterEqual(task.heartbeat, before)
+
+
+    @override_settings(TASKSTATE_HEARTBEAT_TIMEOUT=120)
+    def test_fail_dead(self):
+        dead = self.create_running_task(heartbeat_age=600)
+        alive = self.create_running_task(heartbeat_age=10)
+        done = create_task(
+            status=Task.STATUS_DONE,
+            heartbeat=timezone.now() - timedelta(seconds=600),
+        )
+        self.assertEqual(Task.objects.fail_dead(), [dead])
+        statuses = dict(Task.objects.values_list('pk', 'status'))
+        self.assertEqual(statuses, {
+            dead.pk: Task.STATUS_FAILED,
+            alive.pk: Task.STATUS_RUNNING,
+            done.pk: Task.STATUS_DONE,
+        })
+
+
+    def test_fail_dead_without_heartbeat(self):
+        old = self.create_running_task()
+        new = self.create_running_task()
+        Task.objects.filter(pk=old.pk).update(
+            last_modified=timezone.now() - timedelta(seconds=600),
+        )
+        self.assertEqual(Task.objects.fail_dead(max_age=120), [old])
+        self.assertEqual(
+            Task.objects.get(pk=new.pk).status,
+            Task.STATUS_RUNNING,
+        )
+
+
+    def test_fail_dead_heartbeat_refreshed(self):
+        task = self.create_running_task(heartbeat_age=600)
+        values_list = TaskQuerySet.values_list
+
+        def refresh_heartbeat(queryset, *args, **kwargs):
+            # The heartbeat is refreshed after the dead tasks are selected.
+            pk_list = list(values_list(queryset, *args, **kwargs))
+            Task.objects.update_heartbeats([task.pk])
+            return pk_list
+
+        with mock.patch.object(TaskQuerySet, 'values_list', refresh_heartbeat):
+            self.assertEqual(Task.objects.fail_dead(max_age=120), [])
+        self.assertEqual(Task.objects.get(pk=task.pk).status, Task.STATUS_RUNNING)
+
+
+    def test_fail_dead_tasks_sends_signal(self):
+        task = self.create_running_task(heartbeat_age=600)
+        changed = []
+
+        def receiver(sender, task, **kwargs):
+            changed.append(task)
+
+        task_changed.connect(receiver, sender=StateMiddleware)
+        try:
+            with override_settings(TASKSTATE_HEARTBEAT_TIMEOUT=120):
+                fail_dead_tasks()
+        finally:
+            task_changed.disconnect(receiver, sender=StateMiddleware)
+        self.assertEqual(changed, [task])
+        self.assertEqual(changed[0].status, Task.STATUS_FAILED)
+
+
+    def test_in_flight(self):
+        middleware = StateMiddleware()
+        message = Message(
+            queue_name='default',
+            actor_name='actor',
+            args=(),
+            kwargs={'for_state': {}},
+            options={},
+        )
+        middleware.before_process_message(None, message)
+        task = Task.objects.get(message_id=message.message_id)
+        self.assertIsNotNone(task.heartbeat)
+        self.assertEqual(middleware.in_flight, {message.message_id: (task.pk, 0)})
+        # Closing the connection would end the test's transaction.
+        with mock.patch('django.db.close_old_connections'):
+            with self.assertNumQueries(1):
+                middleware.send_heartbeats()
+            middleware.after_process_message(None, message)
+            self.assertEqual(middleware.in_flight, {})
+            with self.assertNumQueries(0):
+                middleware.send_heartbeats()
+
+
+
+
+class CurrentTaskTestCase(TestCase):
+
+    def setUp(self):
+        self.task = create_task(status=Task.STATUS_RUNNING)
+        self.current_task = CurrentTask(self.task.pk, self.task.message_id, 0)
+        self.channel_layer = get_channel_layer()
+        self.channel_name = async_to_sync(self.channel_layer.new_channel)()
+        Channel.objects.create(
+            name=self.channel_name,
+            task_pk_list=[self.task.pk],
+        )
+
+
+    def receive(self):
+        return async_to_sync(self.channel_layer.receive)(self.channel_name)
+
+
+    def test_set_progress(self):
+        self.current_task.set_progress(35)
+        task = Task.objects.get(pk=self.task.pk)
+        self.assertEqual(task.progress, 35)
+        self.assertEqual(task.status, Task.STATUS_RUNNING)
+        event = self.receive()
+        self.assertEqual(event['changed_pk'], self.task.pk)
+        self.assertEqual(event['last_modified'], task.last_modified.isoformat())
+        self.assertFalse(event['status_changed'])
+
+
+    def test_update_progress(self):
+        self.assertFalse(self.current_task.update_progress(1, 8, step=25))
+        self.assertTrue(self.current_task.update_progress(2, 8, step=25))
+        self.assertEqual(Task.objects.get(pk=self.task.pk).progress, 25)
+        self.assertEqual(self.receive()['changed_pk'], self.task.pk)
+        self.assertFalse(self.current_task.update_progress(3, 8, step=25))
+
+
+    def test_update_progress_without_items(self):
+        self.assertTrue(self.current_task.update_progress(0, 0))
+        self.assertEqual(Task.objects.get(pk=self.task.pk).progress, 100)
+
+
+    def test_published_by_middleware(self):
+        middleware = StateMiddleware()
+        message = Message(
+            queue_name='default',
+            actor_name='actor',
+            args=(),
+            kwargs={'for_state': {}},
+            options={},
+        )
+        middleware.after_enqueue(None, message, None)
+        self.assertIsNone(StateMiddleware.get_current_task())
+        # The conditional update, fetching the updated task and finding
+        # the channels to notify; the task is not looked up again.
+        with self.assertNumQueries(3):
+            middleware.before_process_message(None, message)
+        task = Task.objects.get(message_id=message.message_id)
+        current_task = StateMiddleware.get_current_task()
+        self.assertEqual(current_task.pk, task.pk)
+        self.assertEqual(current_task.message_id, message.message_id)
+        self.assertEqual(current_task.progress, task.progress)
+        middleware.after_process_message(None, message)
+        self.assertIsNone(StateMiddleware.get_current_task())
+
+        middleware.before_process_message(None, message)
+        self.assertIsNotNone(StateMiddleware.get_current_task())
+        middleware.after_skip_message(None, message)
+        self.assertIsNone(StateMiddleware.get_current_task())
+
+
+
+
+class ClearTasksTestCase(TransactionTestCase):
+    """
+    A `TransactionTestCase` is used because PostgreSQL can't `TRUNCATE` a
+    table with pending foreign key checks from the same transaction.
+    """
+
+    def setUp(self):
+        self.user = get_user_model().objects.create(username='user')
+        self.done = [
+            create_task(status=Task.STATUS_DONE, user=self.user)
+            for i in range(3)
+        ]
+        self.running = create_task(status=Task.STATUS_RUNNING, queue_name='other')
+
+
+    def clear_tasks(self, *args):
+        stdout = StringIO()
+        call_command('clear_tasks', *args, stdout=stdout)
+        return stdout.getvalue()
+
+
+    def test_truncate(self):
+        TaskResults.objects.create(task=self.done[0], data=[1])
+        output = self.clear_tasks('--yes')
+        self.assertIn('Deleted all tasks', output)
+        self.assertFalse(Task.objects.exists())
+        self.assertFalse(TaskResults.objects.exists())
+
+
+    def test_filters(self):
+        output = self.clear_tasks('--yes', '--status', 'done', '--chunk-size', '2')
+        self.assertIn('Deleted 2 of 3 tasks', output)
+        self.assertIn('Deleted 3 tasks', output)
+        self.assertEqual(list(Task.objects.all()), [self.running])
+
+        self.clear_tasks('--yes', '--queue-name', 'default')
+        self.assertTrue(Task.objects.exists())
+        self.clear_tasks('--yes', '--queue-name', 'other')
+        self.assertFalse(Task.objects.exists())
+
+
+    def test_user_and_age_filters(self):
+        self.clear_tasks('--yes', '--user', str(self.user.pk), '--older-than', '60')
+        self.assertEqual(Task.objects.count(), 4)
+        Task.objects.filter(pk=self.done[0].pk).update(
+            created_date=timezone.now() - timedelta(seconds=120),
+        )
+        self.clear_tasks('--yes', '--user', str(self.user.pk), '--older-than', '60')
+        self.assertFalse(Task.objects.filter(pk=self.done[0].pk).exists())
+        self.assertEqual(Task.objects.count(), 3)
+
+
+    def test_dry_run(self):
+        output = self.clear_tasks('--dry-run', '--status', 'done')
+        self.assertIn('Would delete 3 tasks', output)
+        output = self.clear_tasks('--dry-run')
+        self.assertIn('unknown number of tasks', output)
+        with connections['default'].cursor() as cursor:
+            cursor.execute('ANALYZE {0}'.format(Task._meta.db_table))
+        output = self.clear_tasks('--dry-run')
+        self.assertIn('about 4', output)
+        self.assertEqual(Task.objects.count(), 4)
+
+
+    def test_cancelled(self):
+        with mock.patch('builtins.input', return_value='n'):
+            with self.assertRaises(CommandError):
+                self.clear_tasks()
+        self.assertEqual(Task.objects.count(), 4)
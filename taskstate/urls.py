@@ -0,0 +1,16 @@
+"""
+URL routing for the HTTP task status views. These can be used by clients
+that can't use websockets. The server-sent events variant is an ASGI
+consumer; see `taskstate.routing.http_urlpatterns`.
+"""
+
+from django.urls import path
+
+from . import views
+
+
+app_name = 'taskstate'
+
+urlpatterns = [
+    path('task-status/', views.task_status, name='task_status'),
+]
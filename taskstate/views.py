@@ -0,0 +1,109 @@
+from functools import wraps
+
+from django.db.models import Count, Max
+from django.http import HttpResponse, HttpResponseForbidden
+from django.views.decorators.http import condition, require_GET
+
+from taskstate.models import Task, decode_cursor
+from taskstate.serializers import TASK_VALUES_FIELDS, dumps_tasks
+
+
+
+
+def login_required_403(view_func):
+    """
+    Like `login_required`, but responds with `403 Forbidden` instead of
+    redirecting to the login page, which a polling client can't follow.
+    This matches the `TaskStatusStream` consumer.
+    """
+    @wraps(view_func)
+    def wrapper(request, *args, **kwargs):
+        if not request.user.is_authenticated:
+            return HttpResponseForbidden()
+        return view_func(request, *args, **kwargs)
+    return wrapper
+
+
+def get_pk_list(request):
+    """
+    Returns the task primary keys from the `pk` query string parameters,
+    for example: `?pk=1&pk=2`.
+    """
+    pk_list = []
+    for pk in request.GET.getlist('pk'):
+        try:
+            pk_list.append(int(pk))
+        except ValueError:
+            pass
+    return pk_list
+
+
+def get_cursor(request):
+    """
+    Returns the `cursor` query string parameter if it's a valid cursor.
+    """
+    cursor = request.GET.get('cursor', None)
+    try:
+        decode_cursor(cursor)
+    except ValueError:
+        return None
+    return cursor
+
+
+def get_tasks(user, pk_list, cursor=None):
+    task_list = Task.objects.for_read().unseen_for_user(
+        user,
+        pk_list,
+    )
+    if cursor is not None:
+        task_list = task_list.changed_since(cursor)
+    return task_list.values(*TASK_VALUES_FIELDS)
+
+
+def task_status_etag(request):
+    """
+    Derives an ETag from the most recent `last_modified` value (which is
+    indexed) and the number of the requested tasks that are still unseen,
+    so that nothing needs to be serialized to know if the tasks changed.
+    """
+    aggregate = Task.objects.for_read().unseen_for_user(
+        request.user,
+        get_pk_list(request),
+    ).aggregate(
+        last_modified=Max('last_modified'),
+        count=Count('pk'),
+    )
+    last_modified = aggregate['last_modified']
+    return '{0}-{1}-{2}'.format(
+        request.user.pk,
+        aggregate['count'],
+        last_modified.timestamp() if last_modified else 0,
+    )
+
+
+
+
+@login_required_403
+@require_GET
+@condition(etag_func=task_status_etag)
+def task_status(request):
+    """
+    Returns the same payload as the `CheckTaskStatus` websocket consumer for
+    the tasks given in the `pk` query string parameters. Supports
+    `If-None-Match` so that polling clients get a `304 Not Modified`
+    response when none of the tasks have changed. A `cursor` query string
+    parameter can be given to only return tasks that changed since, which
+    also means that the results of a completed task are only sent once.
+    """
+    cursor = get_cursor(request)
+    task_list = list(get_tasks(request.user, get_pk_list(request), cursor=cursor))
+    response = HttpResponse(
+        dumps_tasks(
+            task_list,
+            cursor=cursor,
+            results_for=[task['pk'] for task in task_list],
+        ),
+        content_type='application/json',
+    )
+    response['Cache-Control'] = 'private, no-cache'
+    return response